@@ -1,5 +1,7 @@
+import hashlib
 import numpy as np
 import os
+import torch
 
 from PIL import Image
 
@@ -98,3 +100,58 @@ class cityscapes(Dataset):
     def __len__(self):
         return len(self.filenames)
 
+
+CACHE_COMPLETE = 'complete.txt'
+
+def dataset_key(dataset):
+    #depends on the (absolute) image and label files, so another datadir never reuses a stale cache
+    files = "\n".join(os.path.abspath(f) for f in dataset.filenames + dataset.filenamesGt)
+    return hashlib.md5(files.encode()).hexdigest()
+
+def cache_dataset(dataset, cache_dir):
+    """Decodes and transforms every sample of `dataset` once and stores it in
+    `cache_dir` as a `.pt` shard (uint8 image at final resolution + uint8 label).
+    A marker with the number of shards and the dataset key is written last, see `is_cache_complete`."""
+    os.makedirs(cache_dir, exist_ok=True)
+    # start from an empty cache: drop the marker and the shards of a previous (partial or stale) run
+    for f in os.listdir(cache_dir):
+        if f == CACHE_COMPLETE or f.startswith('shard_'):
+            os.remove(os.path.join(cache_dir, f))
+    for i in range(len(dataset)):
+        image, label = dataset[i]
+        # ToTensor scaled the uint8 pixels by 1/255, so this round-trip is exact
+        image = image.mul(255).round().byte()
+        # written under a tmp name and renamed, so an interrupted run never leaves a torn shard
+        shard_path = os.path.join(cache_dir, f'shard_{i:05d}.pt')
+        torch.save({'img': image, 'lbl': label.byte()}, shard_path + '.tmp')
+        os.replace(shard_path + '.tmp', shard_path)
+    with open(os.path.join(cache_dir, CACHE_COMPLETE), 'w') as f:
+        f.write(f'{len(dataset)} {dataset_key(dataset)}')
+
+
+def is_cache_complete(cache_dir, dataset):
+    """True if `cache_dir` holds a finished `cache_dataset` run of the same files as `dataset`."""
+    marker = os.path.join(cache_dir, CACHE_COMPLETE)
+    if not os.path.exists(marker):
+        return False
+    with open(marker) as f:
+        content = f.read().split()
+    num_samples = len(dataset)
+    return (content == [str(num_samples), dataset_key(dataset)]
+            and len(cityscapes_cached(cache_dir)) == num_samples)
+
+
+class cityscapes_cached(Dataset):
+    """Loads the shards written by `cache_dataset`. Images are returned as uint8,
+    the scaling to [0, 1] is left to the consumer (on GPU)."""
+
+    def __init__(self, cache_dir):
+        self.filenames = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.pt')]
+        self.filenames.sort()
+
+    def __getitem__(self, index):
+        shard = torch.load(self.filenames[index])
+        return shard['img'], shard['lbl'].long()
+
+    def __len__(self):
+        return len(self.filenames)
@@ -9,7 +9,7 @@ from argparse import ArgumentParser
 import torch.nn.functional as F
 from torchvision.transforms import Compose, ToTensor, Normalize, Resize
 from transform import Relabel, ToLabel, Colorize
-from dataset1 import cityscapes
+from dataset1 import cityscapes, cityscapes_cached, cache_dataset, is_cache_complete
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 import importlib
@@ -43,9 +43,13 @@ def main():
     parser.add_argument('--loadWeights', default="erfnet_pretrained.pth")
     parser.add_argument('--model', default="erfnet") 
     parser.add_argument('--datadir', default="/home/shyam/ViT-Adapter/segmentation/data/cityscapes/")
-    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--num-workers', type=int, default=min(os.cpu_count() or 1, 8))
+    parser.add_argument('--batch-size', type=int, default=8)
     parser.add_argument('--cpu', action='store_true')
     parser.add_argument('--mean', default = '') #/save/mean_cityscapes_erfnet.npy
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--half', action='store_true') #FP16 weights instead of autocast
+    parser.add_argument('--cache-dir', default='') #pre-transformed .pt shards, built on first use
     args = parser.parse_args()
 
     #modelpath = args.loadDir +"/" +args.model + ".py"
@@ -60,18 +64,34 @@ def main():
 
     if mean_is_computed:
         pre_computed_mean = np.load(mean_path)
-        pre_computed_mean = torch.from_numpy(pre_computed_mean).cuda()
+        pre_computed_mean = torch.from_numpy(pre_computed_mean).double().cuda()
+        # one row per label class, stored row-major so the per-pixel gather is coalesced
+        assert pre_computed_mean.shape == (NUM_CLASSES, NUM_CLASSES), "Error: precomputed mean must be (NUM_CLASSES, NUM_CLASSES)"
+        pre_computed_mean = pre_computed_mean.contiguous()
         print(f"pre_computed_mean {pre_computed_mean.shape}")
     
     # augmentations to be applied during training
     co_transform = ERFNetTransform(False, augment=False, height=512)
     dataset_train = cityscapes(args.datadir, co_transform, 'train')
-    loader = DataLoader(dataset_train, num_workers=args.num_workers, batch_size=1, shuffle=True)
+    if len(args.cache_dir) > 0:
+        # a missing, partial (interrupted) or other-dataset cache is rebuilt
+        num_samples = len(dataset_train)
+        if not is_cache_complete(args.cache_dir, dataset_train):
+            print("Caching dataset in " + args.cache_dir)
+            cache_dataset(dataset_train, args.cache_dir)
+        dataset_train = cityscapes_cached(args.cache_dir)
+        assert len(dataset_train) == num_samples, "Error: dataset cache does not match the dataset"
+    # keep the workers (and several batches each) ahead of the GPU, prefetching needs at least one worker
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=4) if args.num_workers > 0 else {}
+    loader = DataLoader(dataset_train, num_workers=args.num_workers, batch_size=args.batch_size, shuffle=False, pin_memory=not args.cpu, **worker_kwargs)
     
     model = ERFNet(NUM_CLASSES+1)
 
     if (not args.cpu):
-        model = torch.nn.DataParallel(model).cuda()
+        model = model.cuda()
+        # DataParallel only adds a scatter/gather per forward when a single GPU is available
+        if torch.cuda.device_count() > 1:
+            model = torch.nn.DataParallel(model)
 
     def load_my_state_dict(model, state_dict):  #custom function to load model when not all dict elements
         own_state = model.state_dict()
@@ -81,6 +101,8 @@ def main():
             if name not in own_state:
                 if name.startswith("module."):
                     own_state[name.split("module.")[-1]].copy_(param)
+                elif "module." + name in own_state:
+                    own_state["module." + name].copy_(param)
                 else:
                     print(name, " not loaded")
                     continue
@@ -90,70 +112,94 @@ def main():
     model = load_my_state_dict(model, torch.load(weightspath, map_location=lambda storage, loc: storage))
     print ("Model and weights LOADED successfully")
     model.eval()
+    use_half = args.half and not args.cpu
+    if use_half:
+        # BN statistics are frozen in eval, so the weights can be cast once
+        model = model.half()
+    # NHWC layout lets cuDNN pick its faster convolution kernels
+    model = model.to(memory_format=torch.channels_last)
+    if hasattr(torch, 'compile') and not args.cpu:
+        # one static graph (and CUDA graph) per batch size: the full batches, plus a single recompile
+        # for the shorter last batch (2975 % 8 = 7 images), instead of a slower dynamic-shape graph
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False, dynamic=False)
     
 
     # Covariance matrix
-    cov_matrix = torch.zeros((NUM_CLASSES, NUM_CLASSES), dtype=torch.float32, device='cuda')
+    cov_matrix = torch.zeros((NUM_CLASSES, NUM_CLASSES), dtype=torch.float64, device="cpu" if args.cpu else 'cuda')
     num_images = 0  
 
-    sum_per_class = torch.zeros((NUM_CLASSES, NUM_CLASSES), dtype=torch.float32, device="cpu" if args.cpu else 'cuda')
+    # [label_class, feature_channel]: the output has one channel per class, so both dims are NUM_CLASSES.
+    # Holds the running sums until it is divided by the pixel counts at the end.
+    mean_per_class = torch.zeros((NUM_CLASSES, NUM_CLASSES), dtype=torch.float64, device="cpu" if args.cpu else 'cuda')
+    assert mean_per_class.shape == (NUM_CLASSES, NUM_CLASSES)
     pixel_count_per_class = torch.zeros(NUM_CLASSES, dtype=torch.int32, device="cpu" if args.cpu else 'cuda')
-
-    for images, labels in tqdm(loader):
-        if not args.cpu:
-            images = images.cuda()
-            #labels = labels.cuda()
+    # pixels that contributed to the covariance (void/255 excluded)
+    num_valid_pixels = torch.zeros((), dtype=torch.int64, device="cpu" if args.cpu else 'cuda')
+
+    # inference mode covers both the forward and the accumulation of the statistics
+    with torch.inference_mode():
+        for images, labels in tqdm(loader):
+            if not args.cpu:
+                images = images.to('cuda', memory_format=torch.channels_last, non_blocking=True)
+                labels = labels.cuda(non_blocking=True)
+            if images.dtype == torch.uint8:
+                # cached shards store raw pixels, scale them as ToTensor does
+                images = images.float().div_(255)
+            if use_half:
+                images = images.half()
+
+            # Flatten labels once per batch, all the class masks are then built on the same device
+            labels_flat = labels.view(-1).long()
+            valid = labels_flat < NUM_CLASSES
            
-        output = None
-        with torch.no_grad():
-            if args.model == "bisenet":
-                result = model(images)[0].squeeze(0)
-            else:
-                result = model(images).squeeze(0)
-            # remove last channel
-            result = result[:NUM_CLASSES]
+            output = None
+            with torch.autocast('cuda', dtype=torch.float16, enabled=not args.cpu and not use_half):
+                if args.model == "bisenet":
+                    result = model(images)[0]
+                else:
+                    result = model(images)
+                # remove last channel and fold the batch into the pixel dimension: (NUM_CLASSES, B*H*W)
+                result = result[:, :NUM_CLASSES].permute(1, 0, 2, 3).reshape(NUM_CLASSES, -1)
+            # accumulate the statistics in double precision, the sums run over every pixel of the dataset
+            result = result.double()
         
-        # If mean is not computed, accumulate sum and count per class
-        if not mean_is_computed:
-            # Accumulate the sum of the output for each class
-            for c in range(NUM_CLASSES):
-                # Create a mask for the pixels corresponding to class `c`
-                mask = (labels == c).squeeze()
-                
-                # Accumulate the sum of the output for class `c`
-                sum_per_class[c] += torch.sum(result[:, mask], dim=1)
-                
-                # Accumulate the count of pixels for class `c`
-                pixel_count_per_class[c] += torch.sum(mask)
-
-        else:
-            for c in range(NUM_CLASSES):
-                # Create a mask for the pixels corresponding to class `c`
-
-                mask = (labels == c).squeeze()
-                # Center the output relative to the precomputed mean
-
-                centered = result[:, mask] - pre_computed_mean[c].unsqueeze(1)
-                print("centered", centered)
-                cov_matrix += centered @ centered.T
+            # If mean is not computed, accumulate sum and count per class
+            if not mean_is_computed:
+                # Scatter every pixel into the row of its class, void/255 pixels are zeroed out.
+                # Masking instead of boolean indexing keeps the step free of device syncs.
+                class_index = labels_flat.clamp(max=NUM_CLASSES-1)
+                mean_per_class.index_add_(0, class_index, result.T * valid.unsqueeze(1))
+                pixel_count_per_class.index_add_(0, class_index, valid.int())
+
+            else:
+                # Center every pixel relative to the precomputed mean of its own class
+                mean_per_pixel = F.embedding(labels_flat.clamp(max=NUM_CLASSES-1), pre_computed_mean)
+                centered = result.T - mean_per_pixel
+                # Pixels without a valid class must not contribute to the covariance
+                centered.masked_fill_(~valid.unsqueeze(1), 0)
+
+                cov_matrix.addmm_(centered.T, centered)
+                num_valid_pixels += valid.sum()
+                if args.debug and num_images == 0:
+                    print("centered", centered.detach().cpu())
             
-        num_images += 1
+            num_images += images.size(0)
 
     # After processing all images, calculate the mean per class
     if not mean_is_computed:
-        for c in range(NUM_CLASSES):
-            if pixel_count_per_class[c] > 0:
-                sum_per_class[c] /= pixel_count_per_class[c]
+        # classes without pixels have a zero sum, dividing them by 1 leaves them at zero
+        mean_per_class /= pixel_count_per_class.clamp_min(1).unsqueeze(1).to(mean_per_class.dtype)
         
-        print(f"Mean per class: {sum_per_class.shape}")
-        np.save(f"{args.loadDir}/save/mean_cityscapes_{args.model}.npy", sum_per_class.data.cpu().numpy())
+        print(f"Mean per class: {mean_per_class.shape}")
+        np.save(f"{args.loadDir}/save/mean_cityscapes_{args.model}.npy", mean_per_class.float().cpu().numpy())  # FP32 on disk, as evalAnomaly expects
         print(f"Mean output saved as '{args.loadDir}/save/mean_cityscapes_{args.model}.npy'")
     else: 
-        print("cov_matrix", cov_matrix)
-        cov_matrix /= (num_images*512*1024)# Normalize by the number of pixels
+        cov_matrix /= num_valid_pixels.double() # Normalize by the number of pixels
+        if not args.cpu:
+            torch.cuda.synchronize()
         print(f"Covariance matrix: {cov_matrix.shape}")
         print("cov_matrix", cov_matrix)
-        np.save(f"{args.loadDir}/save/cov_cityscapes_{args.model}.npy", cov_matrix.data.cpu().numpy())
+        np.save(f"{args.loadDir}/save/cov_cityscapes_{args.model}.npy", cov_matrix.float().cpu().numpy())  # FP32 on disk, as evalAnomaly expects
         print(f"Covariance matrice saved as '{args.loadDir}/save/cov_matrix_{args.model}.npy'")
 
 if __name__ == '__main__':
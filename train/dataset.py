@@ -1,5 +1,6 @@
 import numpy as np
 import os
+import hashlib
 
 from PIL import Image
 
@@ -67,6 +68,7 @@ class cityscapes(Dataset):
         
         self.images_root += subset
         self.labels_root += subset
+        self.subset = subset
 
         print (self.images_root)
         #self.filenames = [image_basename(f) for f in os.listdir(self.images_root) if is_image(f)]
@@ -80,6 +82,37 @@ class cityscapes(Dataset):
 
         self.co_transform = co_transform # ADDED THIS
 
+        self.label_cache = None # path of the pre-decoded labels, see cache_labels()
+        self.label_mmap = None
+
+
+    def label_cache_path(self, cache_dir):
+        #the name depends on the (absolute) label files, so another datadir never reuses a stale cache
+        files = "\n".join(os.path.abspath(f) for f in self.filenamesGt)
+        key = hashlib.md5(files.encode()).hexdigest()[:12]
+        return os.path.join(cache_dir, f'cityscapes_labels_{self.subset}_{key}.npy')
+
+    def cache_labels(self, cache_dir, build=True):
+        #decode every label once into a uint8 (N, H, W) memmap so __getitem__ skips the PNG decode
+        #build=False only attaches an existing cache (e.g. on the ranks that wait for rank 0 to build it)
+        cache_path = self.label_cache_path(cache_dir)
+        if not os.path.exists(cache_path):
+            assert build, f"Error: label cache {cache_path} was not built"
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(image_path_city(self.labels_root, self.filenamesGt[0]), 'rb') as f:
+                w, h = load_image(f).size
+            mmap = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(self.filenamesGt), h, w))
+            for i, filenameGt in enumerate(self.filenamesGt):
+                with open(image_path_city(self.labels_root, filenameGt), 'rb') as f:
+                    mmap[i] = np.array(load_image(f).convert('P'))
+            mmap.flush()
+            del mmap
+            os.replace(tmp_path, cache_path)
+        assert np.load(cache_path, mmap_mode='r').shape[0] == len(self.filenamesGt), "Error: label cache does not match the dataset"
+        self.label_cache = cache_path
+        self.label_mmap = None # opened lazily, once per DataLoader worker
+
 
     def __getitem__(self, index):
         filename = self.filenames[index]
@@ -87,8 +120,13 @@ class cityscapes(Dataset):
 
         with open(image_path_city(self.images_root, filename), 'rb') as f:
             image = load_image(f).convert('RGB')
-        with open(image_path_city(self.labels_root, filenameGt), 'rb') as f:
-            label = load_image(f).convert('P')
+        if self.label_cache is not None:
+            if self.label_mmap is None:
+                self.label_mmap = np.load(self.label_cache, mmap_mode='r')
+            label = Image.fromarray(np.array(self.label_mmap[index])).convert('P')
+        else:
+            with open(image_path_city(self.labels_root, filenameGt), 'rb') as f:
+                label = load_image(f).convert('P')
 
         if self.co_transform is not None:
             image, label = self.co_transform(image, label)
@@ -64,13 +64,19 @@ class iouEval:
         fnmult = (1-x_onehot) * (y_onehot) #times prediction says its not that class and gt says it is
         fn = torch.sum(torch.sum(torch.sum(fnmult, dim=0, keepdim=True), dim=2, keepdim=True), dim=3, keepdim=True).squeeze() 
 
-        self.tp += tp.double().cpu()
-        self.fp += fp.double().cpu()
-        self.fn += fn.double().cpu()
+        #accumulate on the device of the batch, the host copy is deferred to getIoU() (no sync per batch)
+        if self.tp.device != tp.device:
+            self.tp = self.tp.to(tp.device)
+            self.fp = self.fp.to(tp.device)
+            self.fn = self.fn.to(tp.device)
+        self.tp += tp.double()
+        self.fp += fp.double()
+        self.fn += fn.double()
 
     def getIoU(self):
-        num = self.tp
-        den = self.tp + self.fp + self.fn + 1e-15
+        tp, fp, fn = self.tp.cpu(), self.fp.cpu(), self.fn.cpu()
+        num = tp
+        den = tp + fp + fn + 1e-15
         iou = num / den
         return torch.mean(iou), iou     #returns "iou mean", "iou per class"
 
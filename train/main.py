@@ -5,16 +5,18 @@
 
 import os
 import time
+import warnings
 import numpy as np
 import torch
 import math
 
+import PIL
 from PIL import Image, ImageOps
 from argparse import ArgumentParser
 
 from torch.optim import SGD, Adam, lr_scheduler
-from torch.autograd import Variable
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torchvision.transforms import Compose, CenterCrop, Normalize, Resize, Pad
 from torchvision.transforms import ToTensor, ToPILImage
 
@@ -25,6 +27,7 @@ from visualize import Dashboard
 import importlib
 from iouEval import iouEval, getColorEntry
 from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 import sys
 
@@ -40,11 +43,16 @@ from train.augmentations import ERFNetTransform, BiSeNetTrainTransform, BiSeNetE
 NUM_CHANNELS = 3
 NUM_CLASSES = 20  # 19 classes + void
 
+# Pillow-SIMD (versioned as X.Y.Z.postN) speeds up the PIL resize/crop/flip done by the augmentations
+if 'post' not in PIL.__version__ and not os.environ.get('ALLOW_STOCK_PIL'):
+    warnings.warn("Stock Pillow detected: install pillow-simd for faster data augmentation "
+                  "(set ALLOW_STOCK_PIL=1 to silence this warning)")
+
 color_transform = Colorize(NUM_CLASSES)
 image_transform = ToPILImage()
 
     
-def calculate_class_weights(dataloader, num_classes, c=1.02):
+def calculate_class_weights(dataloader, num_classes, c=1.02, device='cpu'):
     """Computes class weights as described in the ENet paper:
 
         w_class = 1 / (ln(c + p_class)),
@@ -62,30 +70,46 @@ def calculate_class_weights(dataloader, num_classes, c=1.02):
     - num_classes (``int``): The number of classes.
     - c (``int``, optional): AN additional hyper-parameter which restricts
     the interval of values for the weights. Default: 1.02.
+    - device (``str``, optional): The device on which the class histogram
+    is accumulated. Default: 'cpu'.
     """
 
-    class_count = 0
+    class_count = torch.zeros(num_classes, dtype=torch.int64, device=device)
     total = 0
     for _, label in dataloader:
-        label = label.cpu().numpy()
-
         # Flatten label
-        flat_label = label.flatten()
+        flat_label = label.to(device, non_blocking=True).long().view(-1)
 
         # Sum up the number of pixels of each class and the total pixel
         # counts for each label
-        class_count += np.bincount(flat_label, minlength=num_classes)
-        total += flat_label.size
+        class_count += torch.bincount(flat_label, minlength=num_classes)
+        total += flat_label.numel()
     
     # Compute propensity score and then the weights for each class
-    propensity_score = class_count / total
-    class_weights = 1 / (np.log(c + propensity_score))
+    propensity_score = class_count.double() / total
+    class_weights = 1 / (torch.log(c + propensity_score))
 
-    return class_weights
+    return class_weights.cpu().numpy()
 
-#@torch.compile
 def train(args, model, enc=False):
     best_acc = 0
+    is_main = args.rank == 0    #only one process writes logs and checkpoints
+    ckpt_executor = ThreadPoolExecutor(max_workers=1)   #checkpoints are written in background, one at a time
+    viz_executor = ThreadPoolExecutor(max_workers=1)    #same for the images sent to visdom
+    pending_saves = []  #futures of the writes in flight
+
+    def wait_saves():
+        #re-raises in the training thread any error of the background writes (disk full, missing dir...)
+        while pending_saves:
+            pending_saves.pop(0).result()
+    pending_paints = []    #futures of the images sent to visdom, checked at every plot
+
+    def check_paints(wait=False):
+        #re-raises the errors of the finished paints (visdom down, bad label value...)
+        for future in [f for f in pending_paints if wait or f.done()]:
+            pending_paints.remove(future)
+            future.result()
+    viz_stream = torch.cuda.Stream() if args.cuda else None    #side stream for their device->host copies
 
     assert os.path.exists(args.datadir), "Error: datadir (dataset directory) could not be loaded"
 
@@ -103,16 +127,37 @@ def train(args, model, enc=False):
     # Dataset and Loader
     dataset_train = cityscapes(args.datadir, co_transform, 'train')
     dataset_val = cityscapes(args.datadir, co_transform_val, 'val')
-
-    loader = DataLoader(dataset_train, num_workers=args.num_workers, batch_size=args.batch_size, shuffle=True)
-    loader_val = DataLoader(dataset_val, num_workers=args.num_workers, batch_size=args.batch_size, shuffle=False)
+    if args.cacheLabels:
+        #only rank 0 builds the caches, the other processes wait and then attach them
+        if is_main:
+            dataset_train.cache_labels("./cache")
+            dataset_val.cache_labels("./cache")
+        if args.distributed:
+            torch.distributed.barrier()
+        dataset_train.cache_labels("./cache", build=False)
+        dataset_val.cache_labels("./cache", build=False)
+
+    # pinned host memory lets the H2D copy overlap with compute (only meaningful when training on GPU)
+    # workers survive across epochs and keep several batches in flight, this needs at least one worker
+    worker_kwargs = dict(persistent_workers=True, prefetch_factor=4) if args.num_workers > 0 else {}
+    # with DDP every process trains on its own shard of the dataset (batch-size is per process)
+    sampler_train = DistributedSampler(dataset_train, shuffle=True) if args.distributed else None
+    loader = DataLoader(dataset_train, num_workers=args.num_workers, batch_size=args.batch_size, shuffle=(sampler_train is None), sampler=sampler_train, pin_memory=args.cuda, **worker_kwargs)
+    loader_val = DataLoader(dataset_val, num_workers=args.num_workers, batch_size=args.batch_size, shuffle=False, pin_memory=args.cuda, **worker_kwargs)
 
     # Calculate/load class weights
     if not os.path.exists(f"./class_weights/enet_class_weights.npy"):
         # enet class weights are calculated 
         # erfnet encoder and decoder class weights are loaded from original github repo
-        weight = calculate_class_weights(loader, NUM_CLASSES)
-        np.save(f"./class_weights/enet_class_weights.npy", weight) # Save weights to disk
+        #one-off pass over the training set without augmentation, so the counts do not depend on random crops
+        dataset_weight = cityscapes(args.datadir, ERFNetTransform(False, augment=False, height=args.height), 'train')
+        if args.cacheLabels:
+            dataset_weight.cache_labels("./cache", build=False)    #built above with dataset_train
+        weight_loader = DataLoader(dataset_weight, num_workers=args.num_workers, batch_size=16, shuffle=False, pin_memory=args.cuda)
+        weight = calculate_class_weights(weight_loader, NUM_CLASSES, device='cuda' if args.cuda else 'cpu')
+        del weight_loader
+        if is_main:
+            np.save(f"./class_weights/enet_class_weights.npy", weight) # Save weights to disk
     else:
         if args.model == "enet":
             weight = np.load(f"./class_weights/enet_class_weights.npy")
@@ -161,12 +206,13 @@ def train(args, model, enc=False):
         automated_log_path = savedir + "/automated_log.txt"
         modeltxtpath = savedir + "/model.txt"    
 
-    if (not os.path.exists(automated_log_path)):    #dont add first line if it exists 
-        with open(automated_log_path, "a") as myfile:
-            myfile.write("Epoch\t\tTrain-loss\t\tTest-loss\t\tTrain-IoU\t\tTest-IoU\t\tlearningRate")
+    if is_main:
+        if (not os.path.exists(automated_log_path)):    #dont add first line if it exists 
+            with open(automated_log_path, "a") as myfile:
+                myfile.write("Epoch\t\tTrain-loss\t\tTest-loss\t\tTrain-IoU\t\tTest-IoU\t\tlearningRate")
 
-    with open(modeltxtpath, "w") as myfile:
-        myfile.write(str(model))
+        with open(modeltxtpath, "w") as myfile:
+            myfile.write(str(model))
 
     start_epoch = 1
     if args.resume:
@@ -176,38 +222,34 @@ def train(args, model, enc=False):
         else:
             filenameCheckpoint = savedir + '/checkpoint.pth.tar'
         assert os.path.exists(filenameCheckpoint), "Error: resume option was used but checkpoint was not found in folder"
-        checkpoint = torch.load(filenameCheckpoint)
+        checkpoint = load_file(filenameCheckpoint, weights_only=False)   #also holds epoch/optimizer state
         start_epoch = checkpoint['epoch']
 
         state_dict = {key.replace("module.", ""): value for key, value in checkpoint['state_dict'].items()}
         model.load_state_dict(state_dict)
         
-        optimizer.load_state_dict(checkpoint['optimizer'])
         best_acc = checkpoint['best_acc']
         print("=> Loaded checkpoint at epoch {})".format(checkpoint['epoch']))
 
     if args.FineTune:
         # Freeze all layers except the last one
-        for param in model.parameters():
-            param.requires_grad = False
+        model.requires_grad_(False)
         
         if args.model == "erfnet" or args.model == "erfnet_isomaxplus": 
-            for param in model.module.decoder.output_conv.parameters():
-                param.requires_grad = True         
+            model.module.decoder.output_conv.requires_grad_(True)
         elif args.model == "bisenet":
-            for param in model.module.conv_out.parameters():
-                param.requires_grad = True
+            model.module.conv_out.requires_grad_(True)
         else: #enet
-            for param in model.module.transposed_conv.parameters():
-                param.requires_grad = True
+            model.module.transposed_conv.requires_grad_(True)
 
-    # Define the optimizer  
+    # Define the optimizer, only on the trainable parameters (no state kept for the frozen ones)
+    params = [param for param in model.parameters() if param.requires_grad]
     if args.model == "erfnet" or args.model == "erfnet_isomaxplus":
-        optimizer = Adam(model.parameters(), 5e-5 if args.FineTune else 5e-4, betas=(0.9, 0.999), eps=1e-08, weight_decay=1e-4)  
+        optimizer = Adam(params, 5e-5 if args.FineTune else 5e-4, betas=(0.9, 0.999), eps=1e-08, weight_decay=1e-4)  
     elif args.model == "bisenet":
-        optimizer = SGD(model.parameters(), lr=2.5e-3 if args.FineTune else 2.5e-2, momentum=0.9, weight_decay=1e-4)
+        optimizer = SGD(params, lr=2.5e-3 if args.FineTune else 2.5e-2, momentum=0.9, weight_decay=1e-4)
     elif args.model == "enet":
-        optimizer = Adam(model.parameters(), lr=5e-5 if args.FineTune else 5e-4, weight_decay=0.0002)
+        optimizer = Adam(params, lr=5e-5 if args.FineTune else 5e-4, weight_decay=0.0002)
 
     # Define the learning rate scheduler
     if args.model == "erfnet" or args.model == "erfnet_isomaxplus" or args.model == "bisenet":
@@ -216,17 +258,58 @@ def train(args, model, enc=False):
     elif args.model == 'enet':
         scheduler = lr_scheduler.StepLR(optimizer, 7 if args.FineTune else 100, 0.1)
 
+    if args.resume:
+        #optimizer and scheduler only exist now: continue the schedule from the checkpoint epoch
+        if 'scheduler' in checkpoint:
+            scheduler.load_state_dict(checkpoint['scheduler'])
+        else:
+            for _ in range(start_epoch - 1):  #older checkpoint: replay the per-epoch steps
+                scheduler.step()
+        optimizer.load_state_dict(checkpoint['optimizer'])  #after the replay, so the saved lr is kept
+
+    # Mixed precision: FP16 forward/loss, gradients scaled to avoid underflow
+    use_amp = args.amp and args.cuda
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp)
+
     # Visualize the model
     if args.visualize and args.steps_plot > 0:
         board = Dashboard(args.port)
 
+    # options read at every step, bound once to locals
+    steps_plot = args.steps_plot if args.visualize else 0
+    steps_loss = args.steps_loss
+    batch_size = args.batch_size
+    is_cuda = args.cuda
+    is_bisenet = args.model == "bisenet"
+    is_erfnet = args.model == "erfnet" or args.model == "erfnet_isomaxplus"
+
+    def maybe_log_and_viz(prefix, epoch, step, images, outputs, labels, loss_sum, time_sum, n_steps):
+        #shared by the train ('') and val ('VAL ') loops
+        if steps_plot > 0 and step % steps_plot == 0:
+            check_paints()
+            output = outputs[0][0] if isinstance(outputs, list) else outputs[0]   #merge gpu tensors
+            #argmax on gpu, colorizing and sending to visdom happen in the background
+            prediction = output.detach().argmax(0, keepdim=True)
+            (image, prediction, target), ready = to_host_async([images[0].detach(), prediction, labels[0]], viz_stream)
+            pending_paints.append(viz_executor.submit(paint_images, board, image, prediction, target, f'(epoch: {epoch}, step: {step})', prefix, ready))
+        if steps_loss > 0 and step % steps_loss == 0:
+            average = float(loss_sum / n_steps)
+            print(f'{prefix}loss: {average:0.4} (epoch: {epoch}, step: {step})', 
+                    "// Avg time/img: %.4f s" % (time_sum / n_steps / batch_size))
+
     for epoch in range(start_epoch, args.num_epochs+1):
         print("----- TRAINING - EPOCH", epoch, "-----")
 
-        scheduler.step(epoch)
+        if sampler_train is not None:
+            sampler_train.set_epoch(epoch)  #different shuffling at every epoch
 
-        epoch_loss = []
-        time_train = []
+        #one step per epoch, so that the scheduler's last_epoch is the current epoch (also after --resume)
+        scheduler.step()
+
+        #running sums: the loss stays on device and is only synced when printed
+        epoch_loss = 0
+        time_train = 0
+        n_steps = 0
      
         doIouTrain = args.iouTrain   
         doIouVal =  args.iouVal      
@@ -244,61 +327,47 @@ def train(args, model, enc=False):
             # Monitor training time
             start_time = time.time()
 
-            if args.cuda:
-                images = images.cuda()
-                labels = labels.cuda()
-
-            inputs = Variable(images)
-            targets = Variable(labels)
+            if is_cuda:
+                images = images.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
+                labels = labels.cuda(non_blocking=True)
+            # labels are single-channel: squeeze once for the losses, the 4D tensor is kept for IoU/visualization
+            targets = labels[:, 0].contiguous()
 
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             
-            if args.model == "erfnet" or args.model == "erfnet_isomaxplus":
-                outputs = model(inputs, only_encode=enc) 
-            else:
-                outputs = model(inputs)
-
-            if args.model == "bisenet":
-                # combine the principal loss with the auxiliary losses 
-                loss_out = criterion_out(outputs[0], targets[:, 0])
-                loss_aux16 = criterion_aux16(outputs[1], targets[:, 0])
-                loss_aux32 = criterion_aux32(outputs[2], targets[:, 0])
-                loss = loss_out + loss_aux16 + loss_aux32
-            else:
-                loss = criterion(outputs, targets[:, 0])
+            with torch.autocast('cuda', dtype=torch.float16, enabled=use_amp):
+                if is_erfnet:
+                    outputs = model(images, only_encode=enc) 
+                else:
+                    outputs = model(images)
+
+                if is_bisenet:
+                    # combine the principal loss with the auxiliary losses 
+                    loss_out = criterion_out(outputs[0], targets)
+                    loss_aux16 = criterion_aux16(outputs[1], targets)
+                    loss_aux32 = criterion_aux32(outputs[2], targets)
+                    loss = loss_out + loss_aux16 + loss_aux32
+                else:
+                    loss = criterion(outputs, targets)
 
-            loss.backward()
-            optimizer.step()
+            # the scaler is a no-op when AMP is disabled
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
-            epoch_loss.append(loss.item())
-            time_train.append(time.time() - start_time)
+            epoch_loss += loss.detach()
+            time_train += time.time() - start_time
+            n_steps += 1
 
             if (doIouTrain):
-                if args.model == "bisenet":
-                    iouEvalTrain.addBatch(outputs[0].max(1)[1].unsqueeze(1).data, targets.data)
+                if is_bisenet:
+                    iouEvalTrain.addBatch(outputs[0].argmax(1, keepdim=True).detach(), labels)
                 else:
-                    iouEvalTrain.addBatch(outputs.max(1)[1].unsqueeze(1).data, targets.data)
+                    iouEvalTrain.addBatch(outputs.argmax(1, keepdim=True).detach(), labels)
                 
-            if args.visualize and args.steps_plot > 0 and step % args.steps_plot == 0:
-                start_time_plot = time.time()
-                image = inputs[0].cpu().data
-
-                board.image(image, f'input (epoch: {epoch}, step: {step})')
-                if isinstance(outputs, list):   #merge gpu tensors
-                    board.image(color_transform(outputs[0][0].cpu().max(0)[1].data.unsqueeze(0)),
-                    f'output (epoch: {epoch}, step: {step})')
-                else:
-                    board.image(color_transform(outputs[0].cpu().max(0)[1].data.unsqueeze(0)),
-                    f'output (epoch: {epoch}, step: {step})')
-                board.image(color_transform(targets[0].cpu().data),
-                    f'target (epoch: {epoch}, step: {step})')
-                print ("Time to paint images: ", time.time() - start_time_plot)
-            if args.steps_loss > 0 and step % args.steps_loss == 0:
-                average = sum(epoch_loss) / len(epoch_loss)
-                print(f'loss: {average:0.4} (epoch: {epoch}, step: {step})', 
-                        "// Avg time/img: %.4f s" % (sum(time_train) / len(time_train) / args.batch_size))
-
-        average_epoch_loss_train = sum(epoch_loss) / len(epoch_loss)
+            maybe_log_and_viz('', epoch, step, images, outputs, labels, epoch_loss, time_train, n_steps)
+
+        average_epoch_loss_train = float(epoch_loss / n_steps)
         
         iouTrain = 0
         if (doIouTrain):
@@ -309,65 +378,56 @@ def train(args, model, enc=False):
         #Validate on 500 val images after each epoch of training
         print("----- VALIDATING - EPOCH", epoch, "-----")
         model.eval()
-        epoch_loss_val = []
-        time_val = []
+        epoch_loss_val = 0
+        time_val = 0
+        n_steps_val = 0
 
         if (doIouVal):
             iouEvalVal = iouEval(NUM_CLASSES)
 
-        for step, (images, labels) in enumerate(loader_val):
-            start_time = time.time()
-            if args.cuda:
-                images = images.cuda()
-                labels = labels.cuda()
-
-            inputs = Variable(images, volatile=True)    #volatile flag makes it free backward or outputs for eval
-            targets = Variable(labels, volatile=True)
-
-            if args.model == "erfnet" or args.model == "erfnet_isomaxplus":
-                outputs = model(inputs, only_encode=enc) 
-            else: 
-                outputs = model(inputs)
-
-            if args.model == "bisenet":
-                # combine the principal loss with the auxiliary losses 
-                loss_out = criterion_out(outputs[0], targets[:, 0])
-                loss_aux16 = criterion_aux16(outputs[1], targets[:, 0])
-                loss_aux32 = criterion_aux32(outputs[2], targets[:, 0])
-                loss = loss_out + loss_aux16 + loss_aux32
-            else:
-                loss = criterion(outputs, targets[:, 0])
+        #the auxiliary heads only matter for val when the val loss selects the best model (no IoU):
+        #decided per epoch, so that the logged val loss is always averaged over the same terms
+        need_aux_loss = not doIouVal
+
+        # no autograd bookkeeping at all during validation
+        with torch.inference_mode():
+            for step, (images, labels) in enumerate(loader_val):
+                start_time = time.time()
+                if is_cuda:
+                    images = images.cuda(non_blocking=True).contiguous(memory_format=torch.channels_last)
+                    labels = labels.cuda(non_blocking=True)
+                # labels are single-channel: squeeze once for the losses, the 4D tensor is kept for IoU/visualization
+                targets = labels[:, 0].contiguous()
+
+                with torch.autocast('cuda', dtype=torch.float16, enabled=use_amp):
+                    if is_erfnet:
+                        outputs = model(images, only_encode=enc) 
+                    else: 
+                        outputs = model(images)
+
+                    if is_bisenet:
+                        loss = criterion_out(outputs[0], targets)
+                        if need_aux_loss:
+                            # combine the principal loss with the auxiliary losses 
+                            loss = loss + criterion_aux16(outputs[1], targets) + criterion_aux32(outputs[2], targets)
+                    else:
+                        loss = criterion(outputs, targets)
             
-            epoch_loss_val.append(loss.item())
-            time_val.append(time.time() - start_time)
-
-            #Add batch to calculate TP, FP and FN for iou estimation
-            if (doIouVal):
-                if args.model == "bisenet":
-                    iouEvalVal.addBatch(outputs[0].max(1)[1].unsqueeze(1).data, targets.data)
-                else:
-                    iouEvalVal.addBatch(outputs.max(1)[1].unsqueeze(1).data, targets.data)
+                epoch_loss_val += loss.detach()
+                time_val += time.time() - start_time
+                n_steps_val += 1
+
+                #Add batch to calculate TP, FP and FN for iou estimation
+                if (doIouVal):
+                    if is_bisenet:
+                        iouEvalVal.addBatch(outputs[0].argmax(1, keepdim=True).detach(), labels)
+                    else:
+                        iouEvalVal.addBatch(outputs.argmax(1, keepdim=True).detach(), labels)
                 
-            if args.visualize and args.steps_plot > 0 and step % args.steps_plot == 0:
-                start_time_plot = time.time()
-                image = inputs[0].cpu().data
-                board.image(image, f'VAL input (epoch: {epoch}, step: {step})')
-                if isinstance(outputs, list):   #merge gpu tensors
-                    board.image(color_transform(outputs[0][0].cpu().max(0)[1].data.unsqueeze(0)),
-                    f'VAL output (epoch: {epoch}, step: {step})')
-                else:
-                    board.image(color_transform(outputs[0].cpu().max(0)[1].data.unsqueeze(0)),
-                    f'VAL output (epoch: {epoch}, step: {step})')
-                board.image(color_transform(targets[0].cpu().data),
-                    f'VAL target (epoch: {epoch}, step: {step})')
-                print ("Time to paint images: ", time.time() - start_time_plot)
-            if args.steps_loss > 0 and step % args.steps_loss == 0:
-                average = sum(epoch_loss_val) / len(epoch_loss_val)
-                print(f'VAL loss: {average:0.4} (epoch: {epoch}, step: {step})', 
-                        "// Avg time/img: %.4f s" % (sum(time_val) / len(time_val) / args.batch_size))
+                maybe_log_and_viz('VAL ', epoch, step, images, outputs, labels, epoch_loss_val, time_val, n_steps_val)
                        
 
-        average_epoch_loss_val = sum(epoch_loss_val) / len(epoch_loss_val)
+        average_epoch_loss_val = float(epoch_loss_val / n_steps_val)
         
         iouVal = 0
         if (doIouVal):
@@ -383,6 +443,9 @@ def train(args, model, enc=False):
             current_acc = iouVal 
         is_best = current_acc > best_acc
         best_acc = max(current_acc, best_acc)
+        if not is_main:
+            continue    #everything below only saves checkpoints and logs
+        wait_saves()    #previous epoch's checkpoints must be written before submitting new ones
         if enc:
             filenameCheckpoint = savedir + '/checkpoint_enc.pth.tar'
             filenameBest = savedir + '/model_best_enc.pth.tar'    
@@ -392,22 +455,24 @@ def train(args, model, enc=False):
         
         if args.model == "erfnet_isomaxplus":
             # save also the loss_first_part state_dict
-            save_checkpoint({
+            pending_saves.extend(save_checkpoint({
                 'epoch': epoch + 1,
-                'arch': str(model),
+                'arch': type(getattr(model, 'module', model)).__name__,  #full repr is already in model.txt
                 'state_dict': model.state_dict(),
                 'loss_first_part_state_dict': model.module.decoder.state_dict(),
                 'best_acc': best_acc,
                 'optimizer': optimizer.state_dict(),
-            }, is_best, filenameCheckpoint, filenameBest)
+                'scheduler': scheduler.state_dict(),
+            }, is_best, filenameCheckpoint, filenameBest, ckpt_executor))
         else:
-            save_checkpoint({
+            pending_saves.extend(save_checkpoint({
                 'epoch': epoch + 1,
-                'arch': str(model),
+                'arch': type(getattr(model, 'module', model)).__name__,  #full repr is already in model.txt
                 'state_dict': model.state_dict(),
                 'best_acc': best_acc,
                 'optimizer' : optimizer.state_dict(),
-            }, is_best, filenameCheckpoint, filenameBest)
+                'scheduler': scheduler.state_dict(),
+            }, is_best, filenameCheckpoint, filenameBest, ckpt_executor))
 
         #SAVE MODEL AFTER EPOCH
         if (enc):
@@ -423,7 +488,7 @@ def train(args, model, enc=False):
             state = {'state_dict': model.state_dict()}
             if save_isomax and hasattr(model.module.decoder, 'loss_first_part'):
                 state['loss_first_part_state_dict'] = model.module.decoder.loss_first_part.state_dict()
-            torch.save(state, filename)
+            pending_saves.append(ckpt_executor.submit(torch.save, state_to_cpu(state), filename))
 
         if args.epochs_save > 0 and step > 0 and step % args.epochs_save == 0:
             if args.model == "erfnet_isomaxplus":
@@ -452,22 +517,110 @@ def train(args, model, enc=False):
         with open(automated_log_path, "a") as myfile:
             myfile.write("\n%d\t\t%.4f\t\t%.4f\t\t%.4f\t\t%.4f\t\t%.8f" % (epoch, average_epoch_loss_train, average_epoch_loss_val, iouTrain, iouVal, usedLr ))
     
+    wait_saves()    #make sure the last checkpoints are on disk
+    check_paints(wait=True)
+    ckpt_executor.shutdown(wait=True)
+    viz_executor.shutdown(wait=True)
     return(model)   #return model (convenience for encoder-decoder training)
 
-def save_checkpoint(state, is_best, filenameCheckpoint, filenameBest):
-    torch.save(state, filenameCheckpoint)
+def load_file(path, weights_only=True):
+    #mmap the file instead of reading it in memory, tensors are then copied straight from the mapping.
+    #only the mmap failures fall back to a normal read, with the same weights_only restriction
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=weights_only)
+    except TypeError as e:
+        if 'mmap' not in str(e):
+            raise
+        #torch < 2.1 has no mmap argument
+        return torch.load(path, map_location='cpu', weights_only=weights_only)
+    except RuntimeError as e:
+        if 'mmap' not in str(e):
+            raise
+        #files in the legacy (non-zip) format cannot be mapped
+        return torch.load(path, map_location='cpu', mmap=False, weights_only=weights_only)
+
+def to_host_async(tensors, stream):
+    #copy into pinned host memory on a side stream: the default stream keeps running, the copies are
+    #complete once the returned event is synchronized (None when the tensors are already on cpu)
+    if stream is None:
+        return [tensor.cpu() for tensor in tensors], None
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        host = [torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True).copy_(tensor, non_blocking=True) for tensor in tensors]
+        ready = torch.cuda.Event()
+        ready.record(stream)
+    for tensor in tensors:
+        tensor.record_stream(stream)    #keep the allocator from reusing the memory before the copy is done
+    return host, ready
+
+def paint_images(board, image, prediction, target, suffix, prefix='', ready=None):
+    if ready is not None:
+        ready.synchronize()
+    board.image(image, f'{prefix}input {suffix}')
+    board.image(color_transform(prediction), f'{prefix}output {suffix}')
+    board.image(color_transform(target), f'{prefix}target {suffix}')
+
+def state_to_cpu(obj):
+    #snapshot every tensor to host memory, so training can keep updating the originals while the copy is saved
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: state_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(state_to_cpu(value) for value in obj)
+    return obj
+
+def save_checkpoint(state, is_best, filenameCheckpoint, filenameBest, executor=None):
+    #returns the futures of the background writes, the caller must check their result()
+    if executor is None:
+        torch.save(state, filenameCheckpoint)
+        if is_best:
+            print ("Saving model as best")
+            torch.save(state, filenameBest)
+        return []
+    state = state_to_cpu(state)
+    futures = [executor.submit(torch.save, state, filenameCheckpoint)]
     if is_best:
         print ("Saving model as best")
-        torch.save(state, filenameBest)
+        futures.append(executor.submit(torch.save, state, filenameBest))
+    return futures
+
+def wrap_model(args, model):
+    model = model.cuda().to(memory_format=torch.channels_last)
+    if args.distributed:
+        #unused parameters: the erfnet decoder is skipped while training the encoder only
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank], find_unused_parameters=True)
+    else:
+        model = torch.nn.DataParallel(model)
+    return compile_model(model)
+
+def compile_model(model):
+    # nn.Module.compile works in place, so state_dict keys and model.module stay unchanged
+    if hasattr(model, 'compile'):
+        print("Compiling model, the first steps will be slower")
+        model.compile(mode="reduce-overhead", fullgraph=False)
+    return model
 
 def main(args):
+    #launched with torchrun: one process per GPU with DistributedDataParallel, otherwise DataParallel
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    #on cpu every rank would run the whole training and write the same savedir
+    assert args.cuda or world_size == 1, "Error: multi-process (torchrun) training needs --cuda"
+    args.distributed = world_size > 1
+    args.rank = int(os.environ.get("RANK", 0))
+    args.local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if args.distributed:
+        torch.cuda.set_device(args.local_rank)
+        torch.distributed.init_process_group("nccl")
+
     savedir = f'../save/{args.savedir}'
 
     if not os.path.exists(savedir):
-        os.makedirs(savedir)
+        os.makedirs(savedir, exist_ok=True)
 
-    with open(savedir + '/opts.txt', "w") as myfile:
-        myfile.write(str(args))
+    if args.rank == 0:
+        with open(savedir + '/opts.txt', "w") as myfile:
+            myfile.write(str(args))
 
     #Load Model
     if args.model == "erfnet_isomaxplus":
@@ -519,13 +672,13 @@ def main(args):
             return model
         
         if args.model == "enet":
-            model = load_my_state_dict(model, torch.load(weightspath, map_location=lambda storage, loc: storage)["state_dict"])
+            model = load_my_state_dict(model, load_file(weightspath)["state_dict"])
         else:
-            model = load_my_state_dict(model, torch.load(weightspath, map_location=lambda storage, loc: storage))
+            model = load_my_state_dict(model, load_file(weightspath))
         print(f"Import Model {args.model} with weights { args.loadWeights } to FineTune")
     
     if args.cuda:
-        model = torch.nn.DataParallel(model).cuda()
+        model = wrap_model(args, model)
     
     #Load state dict if we are starting from a previous model
     if args.state:
@@ -570,7 +723,7 @@ def main(args):
                     pretrainedEnc = next(model.children()).encoder
                 model = model_file.Net(NUM_CLASSES, encoder=pretrainedEnc)  #Add decoder to encoder
                 if args.cuda:
-                    model = torch.nn.DataParallel(model).cuda()
+                    model = wrap_model(args, model)
                 #When loading encoder reinitialize weights for decoder because they are set to 0 when training dec
         model = train(args, model, False)   #Train decoder
     elif args.model == "bisenet":
@@ -579,6 +732,9 @@ def main(args):
         model = train(args, model)
     print("========== TRAINING FINISHED ===========")
 
+    if args.distributed:
+        torch.distributed.destroy_process_group()
+
 
 if __name__ == '__main__':
     parser = ArgumentParser()
@@ -604,6 +760,8 @@ if __name__ == '__main__':
     parser.add_argument('--iouTrain', action='store_true', default=False) #recommended: False (takes more time to train otherwise)
     parser.add_argument('--iouVal', action='store_true', default=True)  
     parser.add_argument('--resume', action='store_true')    #Use this flag to load last checkpoint for training  
+    parser.add_argument('--amp', action='store_true', default=False)    #mixed precision training (only with --cuda)
+    parser.add_argument('--cacheLabels', action='store_true', default=False)    #decode labels once into ./cache/*.npy memmaps (one per split and datadir)
 
     parser.add_argument('--FineTune', action='store_true', default=False)
     parser.add_argument('--loadWeights', default="erfnet_pretrained.pth")
@@ -73,19 +73,11 @@ class Colorize:
         self.cmap[n] = self.cmap[-1]
         self.cmap = torch.from_numpy(self.cmap[:n])
 
-    def __call__(self, gray_image):
-        size = gray_image.size()
-        #print(size)
-        color_image = torch.ByteTensor(3, size[1], size[2]).fill_(0)
-        #color_image = torch.ByteTensor(3, size[0], size[1]).fill_(0)
-
-        #for label in range(1, len(self.cmap)):
-        for label in range(0, len(self.cmap)):
-            mask = gray_image[0] == label
-            #mask = gray_image == label
+        #lookup table for every uint8 label value, the ones outside the colormap stay black
+        self.palette = torch.zeros(256, 3, dtype=torch.uint8)
+        self.palette[:len(self.cmap)] = self.cmap
 
-            color_image[0][mask] = self.cmap[label][0]
-            color_image[1][mask] = self.cmap[label][1]
-            color_image[2][mask] = self.cmap[label][2]
-
-        return color_image
+    def __call__(self, gray_image):
+        #single gather instead of one masked assignment per label
+        color_image = self.palette[gray_image[0].long().cpu()]
+        return color_image.permute(2, 0, 1).contiguous()